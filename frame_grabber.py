@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import cv2
+import time
+import logging
+import threading
+import numpy as np
+from typing import Callable
+
+# How long (in ms) to wait for the camera when connecting to the stream, and
+# for each frame once connected. The read timeout is what stops a silent
+# stream from blocking the grabber indefinitely - through OpenCV's timeout
+# properties with FFmpeg, and rtspsrc's tcp-timeout with GStreamer.
+STREAM_OPEN_TIMEOUT = 2000
+STREAM_READ_TIMEOUT = 3000
+# Use TCP, so frames aren't lost, and don't hold packets back for reordering
+# for more than half a second
+FFMPEG_CAPTURE_OPTIONS = "rtsp_transport;tcp|max_delay;500000"
+# Used instead of FFmpeg when OpenCV is built with GStreamer. Frames are thinned
+# out to the wanted frame rate before the colour conversion, and the appsink
+# only ever holds the newest one. tcp-timeout (in us) fails the pipeline, ending
+# grab(), if the camera stops sending.
+GSTREAMER_PIPELINE = (
+    'rtspsrc location="{url}" latency=100 protocols=tcp tcp-timeout={tcp_timeout} ! rtph264depay ! h264parse ! avdec_h264 ! '
+    'videorate ! video/x-raw,framerate={fps}/1 ! {converter} ! video/x-raw,format=BGR ! '
+    'appsink max-buffers=1 drop=true sync=false'
+)
+# The element that converts decoded frames to BGR. videoconvert runs on the CPU;
+# on a Pi 4, TIMTAMCAM_GST_CONVERTER=v4l2convert hands the work to the ISP.
+GSTREAMER_CONVERTER = os.environ.get("TIMTAMCAM_GST_CONVERTER", "videoconvert")
+# How long (in seconds) to wait between attempts to reconnect to the stream
+RECONNECT_DELAY = 5
+# If no frame has arrived for this long (in seconds), the camera is down
+STREAM_STALE_TIME = 2
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Keeps a camera stream open in the background, holding on to the most recent
+    `num_frames` frames at `fps`, so there's no need to connect to the camera
+    when we want a video.
+
+    If the stream drops, it reconnects to the same address, then asks
+    `find_camera()` for a new stream URL, first from its caches and then with
+    `force_refresh=True`.
+    """
+
+    def __init__(self, stream_url: str, find_camera: Callable[..., str], fps: int, num_frames: int,
+                 logger: logging.Logger = None):
+        super().__init__(name="frame-grabber", daemon=True)
+        self.stream_url = stream_url
+        self.find_camera = find_camera
+        self.fps = fps
+        self.logger = logger or logging.getLogger(__name__)
+
+        # The frames are retrieved straight into a ring buffer, which is
+        # allocated once the frame size is known. It holds `count` frames, and
+        # `next_slot` is the next one to be overwritten.
+        self.num_frames = num_frames
+        self.ring = None
+        self.count = 0
+        self.next_slot = 0
+        self.last_frame_time = 0
+        self.lock = threading.Lock()
+
+        os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", FFMPEG_CAPTURE_OPTIONS)
+        self.use_gstreamer = re.search(r"GStreamer:\s+YES", cv2.getBuildInformation()) is not None
+
+    def run(self):
+        failures = 0
+        while True:
+            cap = None
+            try:
+                if failures >= 2:
+                    # Try the cheap, cached lookups first, and only sweep the
+                    # network if that address didn't work either
+                    self.stream_url = self.find_camera(force_refresh=failures > 2)
+
+                cap = self.open_stream()
+                if not cap.isOpened():
+                    failures += 1
+                    self.logger.error("Could not connect to the camera stream")
+                    time.sleep(RECONNECT_DELAY)
+                    continue
+
+                self.logger.debug("Connected to stream URL")
+                with self.lock:
+                    self.count = 0
+                    self.next_slot = 0
+                interval = max(1, int(cap.get(cv2.CAP_PROP_FPS)) // self.fps)
+
+                # Grab every frame, to keep up with the stream, but only retrieve
+                # (convert to BGR and copy out) every `interval`th one
+                countdown = interval
+                while cap.grab():
+                    countdown -= 1
+                    if countdown:
+                        continue
+                    countdown = interval
+
+                    if not self.retrieve(cap):
+                        break
+                    # Only a frame we could actually use means the stream works
+                    failures = 0
+
+                self.logger.error("Lost the camera stream")
+                failures += 1
+                time.sleep(RECONNECT_DELAY)
+            except RuntimeError as e:
+                self.logger.error(e)
+                failures += 1
+                time.sleep(RECONNECT_DELAY)
+            except Exception:
+                # Anything else (e.g. a network error while looking for the
+                # camera) mustn't kill the thread, or we'd never record again
+                self.logger.exception("Camera capture failed")
+                failures += 1
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                if cap is not None:
+                    cap.release()
+
+    def retrieve(self, cap) -> bool:
+        """
+        Retrieve the grabbed frame into the next slot of the ring buffer
+        """
+        with self.lock:
+            slot = self.ring[self.next_slot] if self.ring is not None else None
+            ret, frame = cap.retrieve(slot)
+            if not ret or frame is None or frame.size == 0:
+                return False
+
+            if slot is None or frame.shape != slot.shape:
+                # First frame, or the stream has changed size
+                self.ring = np.empty((self.num_frames, *frame.shape), dtype=frame.dtype)
+                self.count = 0
+                self.next_slot = 0
+                self.ring[0] = frame
+
+            self.next_slot = (self.next_slot + 1) % self.num_frames
+            self.count = min(self.count + 1, self.num_frames)
+            self.last_frame_time = time.monotonic()
+            return True
+
+    def snapshot(self) -> np.ndarray:
+        """
+        A copy of the most recent frames, oldest first
+        """
+        with self.lock:
+            if not self.count or time.monotonic() - self.last_frame_time > STREAM_STALE_TIME:
+                raise RuntimeError("Camera is unreachable, or had other error.")
+
+            if self.count < self.num_frames:
+                return self.ring[:self.count].copy()
+            # The ring is full, so the oldest frame is the next to be overwritten
+            return np.concatenate((self.ring[self.next_slot:], self.ring[:self.next_slot]))
+
+    def open_stream(self):
+        timeouts = [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, STREAM_OPEN_TIMEOUT,
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC, STREAM_READ_TIMEOUT,
+        ]
+
+        if self.use_gstreamer:
+            pipeline = GSTREAMER_PIPELINE.format(url=self.stream_url, fps=self.fps,
+                                                 tcp_timeout=STREAM_READ_TIMEOUT * 1000,
+                                                 converter=GSTREAMER_CONVERTER)
+            # The GStreamer backend doesn't support OpenCV's timeout properties,
+            # and refuses to open at all if they're given - the pipeline has
+            # its own
+            cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+            if cap.isOpened():
+                return cap
+            cap.release()
+            self.logger.warning("Could not open the stream with GStreamer, falling back to FFmpeg")
+
+        return cv2.VideoCapture(self.stream_url, cv2.CAP_FFMPEG, timeouts)
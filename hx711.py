@@ -16,6 +16,10 @@ class HX711:
         # software try to access get values from the class at the same time.
         self.readLock = threading.Lock()
 
+        # Whether we can sleep on DOUT's falling edge while waiting for a
+        # sample. Cleared if edge detection isn't available on this pin.
+        self.waitForEdge = True
+
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.PD_SCK, GPIO.OUT)
         GPIO.setup(self.DOUT, GPIO.IN)
@@ -91,15 +95,25 @@ class HX711:
     def readNextByte(self):
         byteValue = 0
 
+        # This runs 24 times per sample, so look everything up once, and clock
+        # the bits in directly rather than through readNextBit().
+        output = GPIO.output
+        read = GPIO.input
+        pd_sck = self.PD_SCK
+        dout = self.DOUT
+
         # Read bits and build the byte from top, or bottom, depending
         # on whether we are in MSB or LSB bit mode.
-        for x in range(8):
-            if self.bit_format == 'MSB':
-                byteValue <<= 1
-                byteValue |= self.readNextBit()
-            else:
-                byteValue >>= 1
-                byteValue |= self.readNextBit() * 0x80
+        if self.bit_format == 'MSB':
+            for x in range(8):
+                output(pd_sck, True)
+                output(pd_sck, False)
+                byteValue = (byteValue << 1) | read(dout)
+        else:
+            for x in range(8):
+                output(pd_sck, True)
+                output(pd_sck, False)
+                byteValue = (byteValue >> 1) | (read(dout) * 0x80)
 
         # Return the packed byte.
         return byteValue
@@ -107,27 +121,33 @@ class HX711:
 
     def readRawBytes(self):
         # Wait for and get the Read Lock, incase another thread is already
-        # driving the HX711 serial interface.
-        self.readLock.acquire()
-
-        # Wait until HX711 is ready for us to read a sample.
-        while not self.is_ready():
-            time.sleep(0.01)
-
-        # Read three bytes of data from the HX711.
-        firstByte  = self.readNextByte()
-        secondByte = self.readNextByte()
-        thirdByte  = self.readNextByte()
-
-        # HX711 Channel and gain factor are set by number of bits read
-        # after 24 data bits.
-        for i in range(self.GAIN):
-            # Clock a bit out of the HX711 and throw it away.
-            self.readNextBit()
-
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()
+        # driving the HX711 serial interface. It's released once we've
+        # finished, even if reading fails.
+        with self.readLock:
+            # Wait until HX711 is ready for us to read a sample. DOUT goes low
+            # when it is, so sleep until that falling edge instead of polling
+            # for it. The timeout covers an edge that lands just before we
+            # start waiting.
+            while not self.is_ready():
+                if self.waitForEdge:
+                    try:
+                        GPIO.wait_for_edge(self.DOUT, GPIO.FALLING, timeout=100)
+                        continue
+                    except RuntimeError:
+                        # e.g. edge detection is already in use on this pin
+                        self.waitForEdge = False
+                time.sleep(0.01)
+
+            # Read three bytes of data from the HX711.
+            firstByte  = self.readNextByte()
+            secondByte = self.readNextByte()
+            thirdByte  = self.readNextByte()
+
+            # HX711 Channel and gain factor are set by number of bits read
+            # after 24 data bits.
+            for i in range(self.GAIN):
+                # Clock a bit out of the HX711 and throw it away.
+                self.readNextBit()
 
         # Depending on how we're configured, return an ordered list of raw byte
         # values.
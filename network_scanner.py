@@ -1,30 +1,115 @@
 #!/usr/bin/env python3
 
-from scapy.all import arping
+import time
+import inspect
+import logging
+import threading
 
+from scapy.all import conf, Ether, ARP
+from scapy.sendrecv import SndRcvHandler
 
-def scan(ip_range: str):
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) a resolved MAC -> IP mapping is trusted for
+IP_CACHE_TTL = 3600
+
+# MAC (upper case) -> (IP, expiry time)
+_ip_cache = {}
+
+# A single layer 2 socket, opened on first use and kept for the life of the
+# process. Scapy sockets aren't thread safe, so all access goes through the lock.
+# It only sees ARP, but that still includes every broadcast on the LAN, which
+# queues up between lookups, so it's drained before each one.
+_socket = None
+_socket_lock = threading.Lock()
+
+# sr() only takes a stop_filter from scapy 2.6. Older versions (e.g. 2.5, as
+# shipped with Debian bookworm) reject it, so wait out the timeout instead.
+_SUPPORTS_STOP_FILTER = "stop_filter" in inspect.signature(SndRcvHandler.__init__).parameters
+
+
+def _drain():
+    """
+    Throw away anything received since the last lookup, so a late reply to an
+    old request can't be taken as the answer to a new one
+    """
+    while _socket.select([_socket], 0):
+        _socket.recv_raw()
+
+
+def _send_receive(packets, timeout: float, first_only: bool = False, stop_filter=None):
+    global _socket
+
+    with _socket_lock:
+        try:
+            if _socket is None:
+                # Leave the interface out of promiscuous mode - the replies
+                # we're after are addressed to us anyway
+                _socket = conf.L2socket(iface=conf.iface, filter="arp", promisc=False)
+            _drain()
+
+            if first_only:
+                return _socket.sr1(packets, timeout=timeout, verbose=False)
+            if stop_filter is not None and _SUPPORTS_STOP_FILTER:
+                responses, _ = _socket.sr(packets, timeout=timeout, verbose=False, stop_filter=stop_filter)
+            else:
+                responses, _ = _socket.sr(packets, timeout=timeout, verbose=False)
+            return responses
+        except PermissionError:
+            raise
+        except OSError as e:
+            # Most likely the interface went down. Drop the socket, so the next
+            # call opens a fresh one, and report no answers.
+            logger.error(f"ARP request failed: {e}")
+            if _socket is not None:
+                try:
+                    _socket.close()
+                except OSError:
+                    pass
+                _socket = None
+            return None if first_only else []
+
+
+def is_at(ip: str, mac: str) -> bool:
+    """
+    Check whether the device with the given MAC still answers for the given IP
+    """
     try:
-        responses, _ = arping(ip_range, verbose=False)
+        reply = _send_receive(Ether(dst=mac) / ARP(pdst=ip), timeout=0.2, first_only=True)
     except PermissionError:
-        print("Need root to arp scan")
-        return []
+        logger.error("Need root to arp scan")
+        return False
+
+    return reply is not None and reply.src.upper() == mac.upper()
 
-    devices = []
-    for response in responses:
-        ip = response.answer.psrc
-        mac = response.answer.src
 
-        devices.append({
-            "ip": ip,
-            "mac": mac,
-        })
+def find_ip_by_mac(ip_range: str, mac: str, force_refresh: bool = False) -> str:
+    cached = _ip_cache.get(mac.upper())
+    if cached and not force_refresh:
+        ip, expiry = cached
+        if time.monotonic() < expiry and is_at(ip, mac):
+            return ip
 
-    return devices
+    # Address the ARP requests straight to the MAC we're after, rather than
+    # broadcasting them. Only that device will see (and answer) them, so we
+    # don't need to collect and filter every responder on the network. The
+    # rest of the range never answers, so stop at the first reply from it
+    # rather than waiting out the timeout.
+    def is_reply_from_mac(packet):
+        return ARP in packet and packet[ARP].op == 2 and packet.src.upper() == mac.upper()
 
+    try:
+        responses = _send_receive(Ether(dst=mac) / ARP(pdst=ip_range), timeout=1,
+                                  stop_filter=is_reply_from_mac)
+    except PermissionError:
+        logger.error("Need root to arp scan")
+        return None
+
+    for response in responses:
+        if response.answer.src.upper() == mac.upper():
+            ip = response.answer.psrc
+            _ip_cache[mac.upper()] = (ip, time.monotonic() + IP_CACHE_TTL)
+            return ip
 
-def find_ip_by_mac(ip_range: str, mac: str) -> str:
-    for device in scan(ip_range):
-        if device["mac"].upper() == mac.upper():
-            return device["ip"]
+    _ip_cache.pop(mac.upper(), None)
     return None
@@ -1,14 +1,106 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import logging
-import backoff
+import functools
+import threading
 import urllib.error
-from typing import Union
+from typing import Optional, Union
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from slack import WebClient
 from slack.errors import SlackApiError
 
+# How many messages to delete at once. Kept low, as chat.delete is rate limited.
+DELETE_WORKERS = 4
+
+# Calls per minute allowed for each Web API method, going by Slack's rate limit
+# tiers (https://api.slack.com/docs/rate-limits). Anything not listed is
+# assumed to be tier 2.
+RATE_LIMITS = {
+    "chat_postMessage": 60,
+    "chat_postEphemeral": 100,
+    "chat_delete": 50,
+    "conversations_join": 50,
+    "conversations_history": 50,
+    "conversations_list": 20,
+    "files_upload": 20,
+    "users_list": 20,
+}
+DEFAULT_RATE_LIMIT = 20
+RATE_LIMIT_WINDOW = 60
+# How many times to retry a call that Slack rejected for rate limiting
+RATE_LIMIT_RETRIES = 3
+
+# How long (in seconds) channel and user lookups are trusted for
+LOOKUP_CACHE_TTL = 3600
+
+
+def retry_after(api_error: SlackApiError) -> Optional[int]:
+    """
+    How long (in seconds) Slack has asked us to wait, or None
+    """
+    headers = api_error.response.headers or {}
+    value = headers.get("Retry-After", headers.get("retry-after"))
+    return int(value) if value is not None else None
+
+
+class ThrottledClient():
+    """
+    Wraps a WebClient, and holds back calls to any method that has used up its
+    allowance for the last minute, rather than letting Slack reject them. Calls
+    that are rejected anyway are retried once Slack's Retry-After has passed.
+    """
+
+    def __init__(self, client: WebClient, max_retries: int = RATE_LIMIT_RETRIES):
+        self._client = client
+        self._max_retries = max_retries
+        self._lock = threading.Lock()
+        # method name -> times of the calls made in the current window
+        self._calls = defaultdict(deque)
+        # method name -> time before which Slack has told us not to call it
+        self._blocked_until = defaultdict(float)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def throttled(*args, **kwargs):
+            for attempt in range(self._max_retries + 1):
+                self._wait_for_slot(name)
+                try:
+                    return attr(*args, **kwargs)
+                except SlackApiError as api_error:
+                    if api_error.response.get("error") != "ratelimited" or attempt == self._max_retries:
+                        raise
+                    # Hold this method back for exactly as long as Slack asked
+                    delay = retry_after(api_error) or 1
+                    with self._lock:
+                        self._blocked_until[name] = time.monotonic() + delay
+
+        return throttled
+
+    def _wait_for_slot(self, method: str):
+        limit = RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                calls = self._calls[method]
+                while calls and calls[0] <= now - RATE_LIMIT_WINDOW:
+                    calls.popleft()
+
+                wait = self._blocked_until[method] - now
+                if len(calls) >= limit:
+                    wait = max(wait, calls[0] + RATE_LIMIT_WINDOW - now)
+                if wait <= 0:
+                    calls.append(now)
+                    return
+            time.sleep(wait)
+
 
 class SlackBot():
     """
@@ -18,27 +110,33 @@ class SlackBot():
     Based off Lachlan Archibald's excellent implementation from ogdevicebot.
     """
 
-    def __init__(self, name: str, token: str):
-        if not self.logger:
+    def __init__(self, name: str, token: str, max_retries: int = RATE_LIMIT_RETRIES):
+        # Logging is left to the application to configure
+        if not getattr(self, "logger", None):
             self.logger = logging.getLogger(__name__)
-            LOGFILE_FORMAT = '%(asctime)-15s %(module)s %(levelname)s: %(message)s'
-            logging.basicConfig(filename=f"{name}.log", level=logging.INFO, format=LOGFILE_FORMAT)
         if not token or not token.startswith("xoxb"):
             raise RuntimeError("Valid bot token needed - must start with 'xoxb'")
         # Uploading a file can take between 20 and 60 seconds.
-        self.client = WebClient(token=token, timeout=120)
-        if not self.client:
+        client = WebClient(token=token, timeout=120)
+        if not client:
             raise RuntimeError("Slack web client could not start")
+        self.client = ThrottledClient(client, max_retries=max_retries)
+
+        # channel name -> (channel id, expiry time)
+        self._channel_ids = {}
+        # user id -> user, and when that list expires
+        self._users = {}
+        self._users_expiry = 0
 
     def send_file(self, channels: Union[list, str, dict], file_location: str, message: str = None, title: str = None):
-        if type(channels) is list:
-            channels = channels.join(",")
-        if type(channels) is dict:
+        if isinstance(channels, dict):
             channels = channels.get("id")
+        elif isinstance(channels, (list, tuple)):
+            channels = ",".join(channels)
 
         if os.path.getsize(file_location) < 10:
             self.logger.error("File is less than 10 bytes. Not uploading.")
-            self.send_message(self.bot_channel, "GIF was too small. Not uploading.", ephemeral=True)
+            self.send_message(self.bot_channel, "File was too small. Not uploading.", ephemeral=True)
             return
 
         try:
@@ -63,14 +161,48 @@ class SlackBot():
         self.client.conversations_join(channel=channel_id)
 
     def join_channel_by_name(self, channel_name: str):
-        all_channels = self.client.conversations_list(limit=1000)["channels"]
-        matching_channel = next(filter(lambda x: x["name"] == channel_name, all_channels), None)
-        if not matching_channel:
+        channel_id = self._channel_id_for(channel_name)
+        if not channel_id:
             raise RuntimeError(f"Could not find channel with name '{channel_name}'.")
-        self.join_channel_by_id(matching_channel["id"])
+        self.join_channel_by_id(channel_id)
+
+    def _channel_id_for(self, channel_name: str):
+        """
+        Look up a channel's ID by name, or None if there's no such channel
+        """
+        cached = self._channel_ids.get(channel_name)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+
+        # Page through the channels, stopping as soon as we find the one we
+        # want. Remember every channel we pass along the way.
+        expiry = time.monotonic() + LOOKUP_CACHE_TTL
+        cursor = None
+        while True:
+            page_args = {"cursor": cursor} if cursor else {}
+            page = self.client.conversations_list(limit=200, **page_args)
+            for channel in page["channels"]:
+                self._channel_ids[channel["name"]] = (channel["id"], expiry)
+                if channel["name"] == channel_name:
+                    return channel["id"]
+
+            cursor = page.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return None
 
     def get_all_users(self):
-        return self.client.users_list(limit=1000)["members"]
+        if time.monotonic() >= self._users_expiry:
+            members = self.client.users_list(limit=1000)["members"]
+            self._users = {user["id"]: user for user in members}
+            self._users_expiry = time.monotonic() + LOOKUP_CACHE_TTL
+        return list(self._users.values())
+
+    def _user_for(self, user_id: str):
+        """
+        Look up a user by ID, or None if there's no such user
+        """
+        self.get_all_users()
+        return self._users.get(user_id)
 
     def send_message(self, recipient: Union[str, dict], message: str, ephemeral: bool = False):
         """
@@ -102,29 +234,32 @@ class SlackBot():
         """
         self.logger.info("Deleting direct messages sent by bot")
 
-        @backoff.on_exception(backoff.expo, SlackApiError, max_time=60)
         def delete_message(message, conversation):
             try:
                 self.logger.debug(f"Message: <{message['text']}>")
                 self.logger.debug(f"Deleting message <{message['ts']}> from conversation <{conversation['id']}>")
                 self.client.chat_delete(channel=conversation['id'], ts=message['ts'])['ok']
             except SlackApiError as api_error:
-                # if we encounter ratelimiting, raise the exception to backoff
-                if api_error.response["error"] == "ratelimited":
-                    raise
-                # if it's anything else, log and continue.
+                # the client has already retried any ratelimiting, so log and continue.
                 self.logger.error(api_error)
 
         try:
-            # get all conversations (single person direct messages only) from this bot
-            conversations = self.client.conversations_list(types="im")['channels']
-            self.logger.debug("Retrieved <%d> conversations", len(conversations))
-            for conversation in conversations:
-                # for each conversation, delete all messages
-                messages = self.client.conversations_history(channel=conversation['id'])['messages']
-                self.logger.debug("Retrieved <%d> messages in conversation <%s>",
-                            len(messages), conversation['id'])
-                for message in messages:
-                    delete_message(message, conversation)
+            # The web client is thread safe, so run a few deletes at once rather
+            # than waiting on each round trip in turn
+            with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+                deletions = []
+                # get all conversations (single person direct messages only) from this bot
+                conversations = self.client.conversations_list(types="im")['channels']
+                self.logger.debug("Retrieved <%d> conversations", len(conversations))
+                for conversation in conversations:
+                    # for each conversation, delete all messages
+                    messages = self.client.conversations_history(channel=conversation['id'])['messages']
+                    self.logger.debug("Retrieved <%d> messages in conversation <%s>",
+                                len(messages), conversation['id'])
+                    for message in messages:
+                        deletions.append(executor.submit(delete_message, message, conversation))
+
+                for deletion in deletions:
+                    deletion.result()
         except SlackApiError as api_error:
             self.logger.error(api_error)
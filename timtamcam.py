@@ -3,13 +3,20 @@
 import os
 import sys
 import cv2
+import time
 import json
+import socket
 import logging
-import requests
+import tempfile
+import threading
+import subprocess
+import urllib.error
 import argparse
-import imageio
+import functools
+import statistics
+from collections import deque
 from datetime import datetime
-from pygifsicle import optimize
+from concurrent.futures import ThreadPoolExecutor
 
 from slack.errors import SlackApiError
 
@@ -17,12 +24,9 @@ import RPi.GPIO
 from hx711 import HX711
 
 from slackbot import SlackBot
+from frame_grabber import FrameGrabber
 from network_scanner import find_ip_by_mac
 
-# Bot User OAuth Token (Install App Page)
-with open("bot_token.txt", "r") as token_file:
-    bot_token = token_file.readline().strip()
-
 
 LOGFILE_FORMAT = '%(asctime)-15s %(module)s %(levelname)s: %(message)s'
 STDOUT_FORMAT  = '%(asctime)s [%(levelname)s] - %(message)s'
@@ -31,13 +35,57 @@ STDOUT_FORMAT  = '%(asctime)s [%(levelname)s] - %(message)s'
 DELTA_WEIGHT = 10
 TIMTAM_WEIGHT = 18.3
 
+# Samples per second from the HX711 - 10 with its RATE pin tied low, or 80 with
+# it tied high. This is set by the board's wiring, not in software.
+HX711_SAMPLE_RATE = 10
+# The weight is the median of the HX711 readings from the last half second
+WEIGHT_SAMPLES = max(3, HX711_SAMPLE_RATE // 2)
+# If there's been no reading for this long (in seconds), the scales are down
+WEIGHT_STALE_TIME = 5 / HX711_SAMPLE_RATE
+# How long (in seconds) to wait for the first readings from the scales
+SCALES_STARTUP_TIMEOUT = 10
+# How often (in seconds) the monitor loop checks the weight
+WEIGHT_POLL_INTERVAL = 0.05
+# How far back (in seconds) the monitor loop looks for a drop in weight
+THEFT_WINDOW = 2
+
+# The scales' last tare offset, kept next to this file
+TARE_CACHE = ".hx_tare.json"
+
+# The ID of the channel the bot last joined, kept next to this file
+JOINED_CHANNEL_STATE = ".joined_channel"
+
+# The camera's last known IP address, kept next to this file
+CAMERA_IP_CACHE = ".camera_ip.cache"
+RTSP_PORT = 554
+
+# Videos of the thief are encoded to temporary files named like this
+VIDEO_PREFIX = "timtam-thief-"
+# Length (in seconds) and frame rate of the video of the thief
+CLIP_DURATION = 4
+CLIP_FPS = 3
+
+
+# The script directory (where this file, config, etc, is stored)
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+@functools.lru_cache(maxsize=1)
+def load_config():
+    """
+    The bot token (Install App Page), the bots channel, and the camera's details
+    """
+    with open(f"{SCRIPT_DIR}/config.json") as config_file:
+        return json.load(config_file)
+
 
 class TimTamCam(SlackBot):
     """
     Watches the Tim Tams. Ever vigilant.
     """
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, recalibrate=False):
+        self.recalibrate = recalibrate
         self.logger = logging.getLogger(__name__)
         if debug:
             self.setup_logging(logging.DEBUG)
@@ -45,24 +93,45 @@ class TimTamCam(SlackBot):
             self.setup_logging(logging.INFO)
         self.logger.info("Tim Tam Bot starting!")
 
-        super().__init__(name="tim-tam-cam", token=bot_token)
+        config = load_config()
+        super().__init__(name="tim-tam-cam", token=config["bot_token"])
 
-        # The script directory (where this file, config, etc, is stored)
-        self.script_dir = os.path.dirname(os.path.realpath(__file__))
+        self.script_dir = SCRIPT_DIR
+        self.camera_details = config["camera"]
+        self.bot_channel = config["bot_channel"]
+        # Alerts run on their own threads, but only upload one video at a time
+        self.upload_lock = threading.Lock()
 
-        # Get the IP address of the camera
-        self.load_camera_url()
-
-        # Make sure we're in the bots channel
+        # Get the IP address of the camera, and make sure we're in the bots
+        # channel. Neither depends on the other, so do both at once.
         self.logger.info("Joining the bots channel")
-        self.bot_channel = json.load(open(f"{self.script_dir}/bot_channel.json"))
-        self.join_channel_by_id(self.bot_channel["id"])
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            camera_found = executor.submit(self.load_camera_url)
+            channel_joined = executor.submit(self.join_bot_channel)
+            camera_found.result()
+            channel_joined.result()
 
         # Send a test message to Addison, to make sure everything works
-        self.send_message(self.bot_channel, "tim-tam-bot coming online!", ephemeral=True)
+        try:
+            self.send_message(self.bot_channel, "tim-tam-bot coming online!", ephemeral=True)
+        except SlackApiError as api_error:
+            # We joined on a previous run, but have since been removed
+            if api_error.response.get("error") not in ("not_in_channel", "channel_not_found"):
+                raise
+            self.logger.warning("No longer in the bots channel. Joining it again.")
+            self.join_bot_channel(force=True)
+            self.send_message(self.bot_channel, "tim-tam-bot coming online!", ephemeral=True)
+
+        # Let OpenCV spread its per-frame work (overlay, colour conversion)
+        # across every core
+        cv2.setNumThreads(os.cpu_count())
 
         self.mask = None
         self.border = None
+        # The mask and border, scaled to the stream's frame size. Alerts can
+        # overlap, so they're replaced together, under the lock.
+        self.overlay = None
+        self.overlay_lock = threading.Lock()
 
         # The mask is SUBTRACTED, then the border is then ADDED
         if datetime.now().month == 12:
@@ -73,25 +142,79 @@ class TimTamCam(SlackBot):
             self.border = cv2.imread(f"{self.script_dir}/halloween-border.png", cv2.IMREAD_COLOR)
 
 
-    def load_camera_url(self):
-        self.logger.info("Attempting to find camera IP by MAC address")
-        with open(f"{self.script_dir}/camera.json") as cam_file:
-            cam_details = json.load(cam_file)
-            network = cam_details["network"]
-            username = cam_details["username"]
-            password = cam_details["password"]
-            mac = cam_details["mac"]
+    def load_camera_url(self, force_refresh=False):
+        network = self.camera_details["network"]
+        username = self.camera_details["username"]
+        password = self.camera_details["password"]
+        mac = self.camera_details["mac"]
 
         # camera_ip = "192.168.252.22"
-        camera_ip = find_ip_by_mac(network, mac)
+        camera_ip = None if force_refresh else self.load_cached_camera_ip()
 
         if not camera_ip:
-            raise RuntimeError(f"Could not find camera ({mac}) on {network}.")
+            self.logger.info("Attempting to find camera IP by MAC address")
+            camera_ip = find_ip_by_mac(network, mac, force_refresh=force_refresh)
+
+            if not camera_ip:
+                raise RuntimeError(f"Could not find camera ({mac}) on {network}.")
+
+            self.save_cached_camera_ip(camera_ip)
 
         self.logger.info(f"Found camera '{mac}' at '{camera_ip}'.")
 
-        # stream1 is 1080p, stream2 is 360p
-        self.stream_url = f"rtsp://{username}:{password}@{camera_ip}/stream1"
+        # stream1 is 1080p, stream2 is 360p. 360p is plenty to spot a thief,
+        # and every frame is a ninth of the size to decode, buffer and encode.
+        self.stream_url = f"rtsp://{username}:{password}@{camera_ip}/stream2"
+        return self.stream_url
+
+
+    def join_bot_channel(self, force=False):
+        # The bot almost always joined on a previous run, so skip the round trip
+        # to Slack if we've joined this channel before (unless we know that's
+        # out of date)
+        state_path = f"{self.script_dir}/{JOINED_CHANNEL_STATE}"
+        try:
+            if force:
+                os.remove(state_path)
+            else:
+                with open(state_path) as state_file:
+                    if state_file.read().strip() == self.bot_channel["id"]:
+                        return
+        except OSError:
+            pass
+
+        self.join_channel_by_id(self.bot_channel["id"])
+
+        try:
+            with open(state_path, "w") as state_file:
+                state_file.write(self.bot_channel["id"])
+        except OSError as e:
+            self.logger.warning(f"Could not save the joined channel: {e}")
+
+
+    def load_cached_camera_ip(self):
+        """
+        The camera's last known IP, if its RTSP port still accepts connections
+        """
+        try:
+            with open(f"{self.script_dir}/{CAMERA_IP_CACHE}") as cache_file:
+                camera_ip = cache_file.read().strip()
+            socket.create_connection((camera_ip, RTSP_PORT), timeout=0.5).close()
+        except (OSError, ValueError):
+            return None
+        return camera_ip
+
+
+    def save_cached_camera_ip(self, camera_ip):
+        # Write to a temporary file and move it into place, so the cache is
+        # never left half written
+        cache_path = f"{self.script_dir}/{CAMERA_IP_CACHE}"
+        try:
+            with open(f"{cache_path}.tmp", "w") as cache_file:
+                cache_file.write(camera_ip)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except OSError as e:
+            self.logger.warning(f"Could not cache the camera's IP: {e}")
 
 
     def setup_scales(self):
@@ -100,7 +223,60 @@ class TimTamCam(SlackBot):
         self.hx.set_reading_format("MSB", "MSB")
         self.hx.set_reference_unit(446)
         self.hx.reset()
-        self.hx.tare()
+
+        # Taring takes a couple of seconds of samples, and the scales don't
+        # move between restarts, so reuse the last offset unless told not to
+        offset = None if self.recalibrate else self.load_tare_offset()
+        if offset is None:
+            self.logger.info("Taring the scales")
+            self.save_tare_offset(self.hx.tare())
+        else:
+            self.hx.set_offset(offset)
+
+        # Read the scales continuously in the background, so nothing else has
+        # to wait on the HX711
+        self.weight_samples = deque(maxlen=WEIGHT_SAMPLES)
+        self.last_sample_time = 0
+        sampler = threading.Thread(target=self.sample_weight, name="weight-sampler", daemon=True)
+        sampler.start()
+        deadline = time.monotonic() + SCALES_STARTUP_TIMEOUT
+        while len(self.weight_samples) < WEIGHT_SAMPLES:
+            if not sampler.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("No readings from the scales. Check the HX711 wiring.")
+            time.sleep(WEIGHT_POLL_INTERVAL)
+
+
+    def load_tare_offset(self):
+        try:
+            with open(f"{self.script_dir}/{TARE_CACHE}") as tare_file:
+                return json.load(tare_file)["offset"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+    def save_tare_offset(self, offset):
+        try:
+            with open(f"{self.script_dir}/{TARE_CACHE}", "w") as tare_file:
+                json.dump({"offset": offset}, tare_file)
+        except OSError as e:
+            self.logger.warning(f"Could not save the tare offset: {e}")
+
+
+    def sample_weight(self):
+        while True:
+            try:
+                self.weight_samples.append(self.hx.get_weight(1))
+                self.last_sample_time = time.monotonic()
+            except Exception:
+                # Keep sampling - the monitor loop relies on fresh readings
+                self.logger.exception("Failed to read the scales")
+                time.sleep(1)
+
+
+    @property
+    def current_weight(self):
+        # Copy first - the sampler thread is still appending
+        return statistics.median(tuple(self.weight_samples))
 
 
     def setup_logging(self, level=logging.INFO):
@@ -108,7 +284,9 @@ class TimTamCam(SlackBot):
         logging.basicConfig(filename='timtamcam.log', format=LOGFILE_FORMAT)
         self.logger.setLevel(level)
 
-        # Log to stdout
+        # Log to stdout (only once, even if we're set up again)
+        if self.logger.handlers:
+            return
         formatter = logging.Formatter(fmt=STDOUT_FORMAT)
         log_handler_stdout = logging.StreamHandler(sys.stdout)
         log_handler_stdout.setFormatter(formatter)
@@ -117,107 +295,143 @@ class TimTamCam(SlackBot):
 
 
     def alert(self, num_timtams: float, previous_weight: float):
+        """
+        Called on a timer thread, shortly after the theft. Alerts can overlap,
+        so each one encodes its video to its own temporary file.
+        """
+        video_fd, video_path = tempfile.mkstemp(prefix=VIDEO_PREFIX, suffix=".mp4")
+        os.close(video_fd)
         try:
-            self.record_gif(4, 3)
+            self.report_theft(num_timtams, previous_weight, video_path)
+        except Exception:
+            self.logger.exception("Alert failed")
+        finally:
+            os.remove(video_path)
+
+
+    def report_theft(self, num_timtams: float, previous_weight: float, video_path: str):
+        try:
+            self.save_video(video_path)
         except Exception as e:
-            self.logger.error("Failed to record a gif!")
+            self.logger.error("Failed to save a video!")
             self.logger.error(e)
+            self.send_message(self.bot_channel, "Timtams tampering detected! But the camera is disconnected...")
+            return
 
-            # Try to recover the camera
-            try:
-                self.load_camera_url()
-                self.record_gif(4, 3)
-                self.logger.info("Successfully recovered from bad camera!")
-            except Exception:
-                self.send_message(self.bot_channel, "Timtams tampering detected! But the camera is disconnected...")
-                return
-
-        if previous_weight <= self.hx.get_weight(15) + DELTA_WEIGHT:
+        if previous_weight <= self.current_weight + DELTA_WEIGHT:
             self.logger.info("Weight has not changed, after recording video. Will NOT post to Slack.")
             return
 
         try:
-            self.send_file(self.bot_channel, "/tmp/timtam-thief.gif",
-                f"Timtam tampering detected! Someone took {round(num_timtams)} Tim Tams!")
+            with self.upload_lock:
+                self.send_file(self.bot_channel, video_path,
+                    f"Timtam tampering detected! Someone took {round(num_timtams)} Tim Tams!")
         except SlackApiError as api_error:
             self.logger.error(api_error)
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
-
-
-    def record_gif(self, duration, fps):
-        self.logger.info("Recording a gif of the thief")
-        cap = cv2.VideoCapture(self.stream_url)
-        stream_fps = int(cap.get(cv2.CAP_PROP_FPS))
-        # stream_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        # stream_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.logger.debug("Connected to stream URL")
-
-        frames = 0
-        images = []
-        # Record several frames
-        while cap.isOpened() and len(images) < (duration * fps):
-            ret, frame = cap.read()
-            frames += 1
-
-            if (frames % (stream_fps // fps)) == 0:
-                self.camera_check(cap, ret, frame)
-
-                # Save a single image
-                # cv2.imwrite("/tmp/timtam-thief.jpg", frame)
-
-                if self.mask is not None:
-                    # Add overlay
-                    frame = cv2.subtract(frame, self.mask)
-                    frame = cv2.addWeighted(frame, 1, self.border, 1, 0)
-
-                # Convert to RGB for gifs
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                images.append(rgb_frame)
-
-        # Write frames to gif
-        self.logger.debug("Saving timtam thief image.")
-        imageio.mimsave('/tmp/timtam-thief.gif', images, duration=0.2)
-        self.logger.info("Saved gif")
-        optimize('/tmp/timtam-thief.gif')
-        self.logger.info("Optimised gif")
-
-        cap.release()
-
-
-    def camera_check(self, cap, ret, frame):
-        if not cap.isOpened() or not ret or frame is None or frame.size == 0:
-            cap.release()
-            self.logger.error("Critical camera error")
-            raise RuntimeError("Camera is unreachable, or had other error.")
+        except urllib.error.URLError:
+            # send_file has already logged the reason
+            self.logger.error("Could not reach Slack to upload the video")
+
+
+    def setup_camera(self):
+        # Keep the stream open in the background, holding on to the last few
+        # seconds of it, so there's no need to connect when a theft happens
+        self.grabber = FrameGrabber(self.stream_url, self.load_camera_url, CLIP_FPS,
+                                    CLIP_DURATION * CLIP_FPS, logger=self.logger)
+        self.grabber.start()
+
+
+    def save_video(self, video_path: str):
+        frames = self.grabber.snapshot()
+        self.logger.info("Saving a video of the thief")
+
+        height, width = frames[0].shape[:2]
+        if self.mask is not None:
+            mask, border = self.fit_overlay(width, height)
+            for frame in frames:
+                # Add overlay, in place - the snapshot is our own copy
+                cv2.subtract(frame, mask, dst=frame)
+                cv2.add(frame, border, dst=frame)
+
+        # Hand the raw BGR frames to ffmpeg in one go, as they come from the
+        # stream. H.264 in yuv420p plays inline in Slack and browsers.
+        encoder = subprocess.Popen([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(CLIP_FPS), "-i", "-",
+            "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+            video_path,
+        ], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, errors = encoder.communicate(frames.reshape(-1).data)
+        if encoder.returncode != 0:
+            raise RuntimeError(f"Could not encode video: {errors.decode().strip()}")
+
+        self.logger.info("Saved video")
+
+
+    def fit_overlay(self, width, height):
+        """
+        Scale the mask and border to the size of the stream's frames. This is
+        done once, rather than per frame, and OpenCV refuses to composite
+        images of different sizes anyway.
+        """
+        with self.overlay_lock:
+            if self.overlay is None or self.overlay[0].shape[:2] != (height, width):
+                self.logger.debug(f"Scaling overlay to {width}x{height}")
+                self.overlay = (
+                    cv2.resize(self.mask, (width, height), interpolation=cv2.INTER_AREA),
+                    cv2.resize(self.border, (width, height), interpolation=cv2.INTER_AREA),
+                )
+            return self.overlay
 
 
     def monitor_loop(self):
         self.logger.info("Now monitoring Tim Tams")
         item = TIMTAM_WEIGHT
 
-        previous = None
+        # Compare against the heaviest recent weight, rather than just the last
+        # one, so that a slow theft is caught as well as a quick one
+        recent_weights = deque(maxlen=int(THEFT_WINDOW / WEIGHT_POLL_INTERVAL))
+        scales_down = False
         while True:
             try:
-                weight = self.hx.get_weight(15)
-                self.logger.debug(f"Weight: {round(weight, 1)}g")
-                if previous is not None:
-                    hour = datetime.now().hour
-                    weekday = datetime.now().weekday()
-                    if hour >= 18 or hour <= 4 or weekday >= 5:
-                        # Don't record thefts after 5:59pm, or before 4:59am
-                        # Don't record thefts on Saturday/Sunday
-                        previous = None
-                        continue
-
-                    timtam_change = round((previous - weight) / item, 2)
-                    if timtam_change >= 0.85:
-                        # Someone has taken 85% or more of a timtam. Close enough!
-                        self.alert(timtam_change, previous)
-                        previous = None
-                        continue
-
-                previous = weight
+                time.sleep(WEIGHT_POLL_INTERVAL)
+
+                # Without fresh readings the weight never changes, so a theft
+                # would go unnoticed. Say so, rather than failing silently.
+                if time.monotonic() - self.last_sample_time > WEIGHT_STALE_TIME:
+                    if not scales_down:
+                        self.logger.error("No readings from the scales. Not watching for thefts until they're back.")
+                        scales_down = True
+                    recent_weights.clear()
+                    continue
+                if scales_down:
+                    self.logger.info("Readings from the scales are back")
+                    scales_down = False
+
+                weight = self.current_weight
+                self.logger.debug("Weight: %.1fg", weight)
+
+                now = datetime.now()
+                hour = now.hour
+                weekday = now.weekday()
+                if hour >= 18 or hour <= 4 or weekday >= 5:
+                    # Don't record thefts after 5:59pm, or before 4:59am
+                    # Don't record thefts on Saturday/Sunday
+                    recent_weights.clear()
+                    continue
+
+                recent_weights.append(weight)
+                previous = max(recent_weights)
+                timtam_change = round((previous - weight) / item, 2)
+                if timtam_change >= 0.85:
+                    # Someone has taken 85% or more of a timtam. Close enough!
+                    # The camera has already buffered the lead up to the theft.
+                    # Give it a moment to capture the getaway too, in the
+                    # background, and keep watching the scales in the meantime.
+                    alert = threading.Timer(CLIP_DURATION / 2, self.alert, args=(timtam_change, previous))
+                    alert.daemon = True
+                    alert.start()
+                    recent_weights.clear()
 
             except (KeyboardInterrupt, SystemExit) as e:
                 self.logger.error(str(e))
@@ -227,6 +441,9 @@ class TimTamCam(SlackBot):
 
     # This function is run as part of the daemon
     def run(self):
+        self.logger.info("Connecting to the camera")
+        self.setup_camera()
+
         self.logger.info("Setting up the scales")
         self.setup_scales()
 
@@ -242,11 +459,13 @@ if __name__ == "__main__":
     # parser.add_argument("--mac", "-m", type=str, required=True,
     #     help="The MAC address of the camera.")
     parser.add_argument("--debug", "-x", action='store_true', help="Enable debugging.")
+    parser.add_argument("--recalibrate", "-r", action='store_true',
+        help="Tare the scales, rather than reusing the last tare.")
 
     # sys.argv[1:]
     args = parser.parse_args()
 
-    bot = TimTamCam(debug=args.debug)
+    bot = TimTamCam(debug=args.debug, recalibrate=args.recalibrate)
     bot.run()
 
     exit(0)